@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 import os
+import asyncio
+import contextlib
 import logging
-import subprocess
-from urllib.parse import urlparse
+import re
+import tempfile
+import time
+from pathlib import Path
 
-import requests
-from dotenv import load_dotenv
+import aiofiles
+import aiohttp
+import orjson
+from cachetools import TTLCache
 from telegram import Update
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -15,19 +23,15 @@ from telegram.ext import (
     ContextTypes,
 )
 
-#─── Load config ────────────────────────────────────────────────────────────────
-load_dotenv()
-TOKEN         = os.getenv("TELEGRAM_TOKEN")
-LOCAL_API_URL = os.getenv("TELEGRAM_LOCAL_API")  # e.g. "http://127.0.0.1:8081/bot/"
-API_BASE      = os.getenv(
-    "ANIWATCH_API_BASE",
-    "http://localhost:4000/api/v2/hianime"
-)
+from config import settings
 
-if not TOKEN:
-    raise RuntimeError("TELEGRAM_TOKEN not set in .env")
-if not LOCAL_API_URL:
-    raise RuntimeError("TELEGRAM_LOCAL_API not set in .env (must end in /bot/)")
+#─── Load config ────────────────────────────────────────────────────────────────
+CONFIG        = settings()
+TOKEN         = CONFIG.token
+LOCAL_API_URL = CONFIG.local_api_url
+LOCAL_MODE    = CONFIG.local_mode
+MAX_REMUX     = CONFIG.max_remux
+API_BASE      = CONFIG.api_base
 
 #─── Logging ───────────────────────────────────────────────────────────────────
 logging.basicConfig(
@@ -35,50 +39,330 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+#─── HTTP session ──────────────────────────────────────────────────────────────
+# One shared session for all Aniwatch API calls, so its connection pool is
+# reused across updates. Created/closed by the Application lifecycle hooks.
+SESSION: aiohttp.ClientSession | None = None
+
 #─── Helpers ────────────────────────────────────────────────────────────────────
+# …/watch/<slug>/episode-<n> (or ep-<n>)
+_SLUG_EP = re.compile(r"/watch/([^/?#]+)/[^/?#-]*-(\d+)")
+
 def extract_slug_ep(hianime_url: str) -> tuple[str, str]:
-    parts = urlparse(hianime_url).path.strip("/").split("/")
-    return parts[-2], parts[-1].split("-")[-1]
+    m = _SLUG_EP.search(hianime_url.strip())
+    if m is None:
+        raise ValueError("Not an episode URL")
+    return m.group(1), m.group(2)
 
-def get_m3u8_and_referer(
+async def _fetch_m3u8_and_referer(
     slug: str,
     ep: str,
-    server: str = "hd-1",
-    category: str = "sub"
+    server: str,
+    category: str,
 ) -> tuple[str, str|None]:
-    resp = requests.get(
+    async with SESSION.get(
         f"{API_BASE}/episode/sources",
         params={
             "animeEpisodeId": f"{slug}?ep={ep}",
             "server": server,
             "category": category,
         }
-    )
-    resp.raise_for_status()
-    data    = resp.json().get("data", {})
+    ) as resp:
+        resp.raise_for_status()
+        data = orjson.loads(await resp.read()).get("data", {})
     sources = data.get("sources", [])
-    for s in sources:
-        if s.get("type") == "hls" or s.get("url", "").endswith(".m3u8"):
-            m3u8 = s["url"]
-            break
-    else:
+    m3u8 = next(
+        (s["url"] for s in sources
+         if s.get("type") == "hls" or s.get("url", "").endswith(".m3u8")),
+        None,
+    )
+    if m3u8 is None:
         raise RuntimeError("No HLS source found")
     referer = data.get("headers", {}).get("Referer")
     return m3u8, referer
 
-def remux_hls_to_mp4(m3u8_url: str, referer: str|None, output_path: str) -> None:
-    cmd = ["ffmpeg", "-y"]
+@contextlib.asynccontextmanager
+async def keyed_lock(locks: dict, key):
+    # Per-key asyncio.Lock, dropped from `locks` once its last user (holder
+    # or waiter) has left, so every concurrent caller shares the same lock.
+    entry = locks.get(key)
+    if entry is None:
+        entry = locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del locks[key]
+
+# (slug, ep, server, category) → (m3u8, referer). The TTL stays well under the
+# lifetime of the signed playlist URLs the API hands out.
+SOURCE_CACHE: TTLCache = TTLCache(maxsize=512, ttl=300)
+_source_locks: dict[tuple[str, str, str, str], list] = {}
+
+async def get_m3u8_and_referer(
+    slug: str,
+    ep: str,
+    server: str = "hd-1",
+    category: str = "sub"
+) -> tuple[str, str|None]:
+    key = (slug, ep, server, category)
+    hit = SOURCE_CACHE.get(key)
+    if hit is not None:
+        return hit
+    # Single-flight: concurrent misses for the same episode share one API call.
+    async with keyed_lock(_source_locks, key):
+        hit = SOURCE_CACHE.get(key)
+        if hit is None:
+            hit = SOURCE_CACHE[key] = await _fetch_m3u8_and_referer(*key)
+        return hit
+
+def forget_m3u8(
+    slug: str,
+    ep: str,
+    server: str = "hd-1",
+    category: str = "sub"
+) -> None:
+    SOURCE_CACHE.pop((slug, ep, server, category), None)
+
+# Encoder used when a stream can't be stream-copied into MP4. Candidates are
+# tried in order at startup; the first one that actually encodes wins.
+VIDEO_ENCODERS: dict[str, tuple[list[str], list[str]]] = {
+    # name: (args before -i, args after -i)
+    "h264_nvenc": ([], ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-b:v", "4M"]),
+    "h264_qsv":   ([], ["-c:v", "h264_qsv", "-b:v", "4M"]),
+    "h264_vaapi": (
+        ["-vaapi_device", "/dev/dri/renderD128"],
+        ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi", "-b:v", "4M"],
+    ),
+    "libx264":    ([], ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23"]),
+}
+VIDEO_ENCODER = "libx264"
+# libx264 runs on the CPU; never let more than one of those run at a time.
+SOFTWARE_ENCODE_GATE = asyncio.Semaphore(1)
+
+# ffmpeg errors that mean the streams can't go into MP4 as-is. Anything else
+# (403s, expired playlists, dropped connections) would fail a re-encode too.
+_INCOMPATIBLE = re.compile(
+    r"Could not find tag for codec"
+    r"|not currently supported in container"
+    r"|incompatible with output codec"
+    r"|Could not write header"
+)
+
+class FFmpegError(RuntimeError):
+    def __init__(self, returncode: int, stderr: str):
+        lines = stderr.strip().splitlines()
+        super().__init__(f"ffmpeg exited with {returncode}: {lines[-1] if lines else 'no output'}")
+        self.stderr = stderr
+
+# Caps concurrent ffmpeg jobs so they don't fight over disk and bandwidth.
+REMUX_GATE = asyncio.Semaphore(MAX_REMUX)
+_remux_queue = 0  # jobs currently waiting on REMUX_GATE
+
+# Multipart uploads (non-local mode) hold the whole MP4 in memory while they
+# are sent; allow one at a time so concurrent chats can't stack up 2 GB copies.
+UPLOAD_GATE = asyncio.Semaphore(1)
+
+# Finished MP4s in downloads/ are reused for this long before being remuxed
+# again. One lock per output file, so only the first requester of an episode
+# runs ffmpeg and everyone else waits for (and then uploads) its result.
+DOWNLOAD_TTL = 3600
+_download_locks: dict[str, list] = {}
+
+# (slug, ep) → Telegram file_id of an earlier upload. Resending by file_id
+# makes Telegram serve its own copy, with nothing uploaded from here.
+FILE_ID_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=7 * 24 * 3600)
+
+def is_fresh(path: str) -> bool:
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    return st.st_size > 0 and time.time() - st.st_mtime < DOWNLOAD_TTL
+
+async def run_ffmpeg(cmd: list[str]) -> None:
+    # Run ffmpeg without blocking the event loop; communicate() drains stderr
+    # so a chatty ffmpeg can't stall on a full pipe.
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await proc.communicate()
+    except BaseException:
+        # Cancelled (e.g. shutdown): don't leave ffmpeg running as an orphan.
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0:
+        raise FFmpegError(proc.returncode, stderr.decode(errors="replace"))
+
+async def detect_video_encoder() -> str:
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-encoders",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    listed = (await proc.communicate())[0].decode(errors="replace")
+    for name, (pre, post) in VIDEO_ENCODERS.items():
+        if name not in listed:
+            continue
+        # Being compiled in doesn't mean the hardware is there; encode a few
+        # blank frames to be sure.
+        try:
+            await run_ffmpeg([
+                "ffmpeg", "-hide_banner", "-loglevel", "error", *pre,
+                "-f", "lavfi", "-i", "color=c=black:s=256x256:d=0.2",
+                *post, "-f", "null", "-",
+            ])
+        except RuntimeError:
+            continue
+        return name
+    return "libx264"
+
+async def remux_hls_to_mp4(m3u8_url: str, referer: str|None, output_path: str) -> None:
+    cmd = [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        # Keep segment connections alive and fetch the next segment while the
+        # current one is still downloading; retry dropped connections.
+        "-reconnect", "1",
+        "-reconnect_streamed", "1",
+        "-reconnect_delay_max", "5",
+        "-http_persistent", "1",
+        "-http_multiple", "1",
+        "-thread_queue_size", "1024",
+    ]
     if referer:
         cmd += ["-headers", f"Referer: {referer}\r\n"]
-    cmd += ["-i", m3u8_url, "-c", "copy", output_path]
-    subprocess.run(cmd, check=True)
+    # faststart puts the moov atom up front so Telegram clients can start
+    # playback before the whole file has been fetched.
+    out = ["-movflags", "+faststart", output_path]
+    try:
+        await run_ffmpeg(cmd + ["-i", m3u8_url, "-c", "copy", *out])
+    except FFmpegError as e:
+        if not _INCOMPATIBLE.search(e.stderr):
+            raise
+        logging.warning("Stream copy failed (%s); re-encoding with %s", e, VIDEO_ENCODER)
+        pre, post = VIDEO_ENCODERS[VIDEO_ENCODER]
+        gate = SOFTWARE_ENCODE_GATE if VIDEO_ENCODER == "libx264" else contextlib.nullcontext()
+        async with gate:
+            await run_ffmpeg(cmd + pre + ["-i", m3u8_url, *post, "-c:a", "aac", *out])
 
 #─── Bot handlers ───────────────────────────────────────────────────────────────
+# Last text shown per status message, so repeated states cost no API call.
+_last_status: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+async def set_status(msg, text: str) -> None:
+    # Status updates are cosmetic: a failed edit (message deleted, network
+    # hiccup) is logged and must never abort the job it's reporting on.
+    key = (msg.chat_id, msg.message_id)
+    if _last_status.get(key) == text:
+        return
+    try:
+        await msg.edit_text(text)
+    except TelegramError as e:
+        logging.warning("Could not update status message: %s", e)
+        return
+    _last_status[key] = text
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(
         "👋 Hi! Send me a Hianime.to episode URL and I'll download and send the MP4 (up to 2 GB)."
     )
 
+@contextlib.asynccontextmanager
+async def remux_slot(status):
+    global _remux_queue
+    if REMUX_GATE.locked():
+        _remux_queue += 1
+        try:
+            await set_status(status, f"⏳ Queued (position {_remux_queue}), waiting for a free slot…")
+            await REMUX_GATE.acquire()
+        finally:
+            _remux_queue -= 1
+    else:
+        await REMUX_GATE.acquire()
+    try:
+        yield
+    finally:
+        REMUX_GATE.release()
+
+async def fetch_episode(slug: str, ep: str, out_file: str, status) -> None:
+    m3u8_url, referer = await get_m3u8_and_referer(slug, ep)
+    # Remux into a private temp file next to the target and rename on success,
+    # so a half-written file is never mistaken for a cached one.
+    fd, tmp_file = tempfile.mkstemp(
+        prefix=f"{slug}_{ep}.", suffix=".part.mp4", dir="downloads"
+    )
+    os.close(fd)
+    try:
+        async with remux_slot(status):
+            remux = asyncio.ensure_future(remux_hls_to_mp4(m3u8_url, referer, tmp_file))
+            try:
+                # Short remuxes go straight from "Fetching" to "Uploading".
+                try:
+                    await asyncio.wait_for(asyncio.shield(remux), timeout=2)
+                except asyncio.TimeoutError:
+                    await set_status(status, "⏳ Downloading & remuxing…")
+                    await remux
+            except RuntimeError:
+                # Most likely an expired/rejected playlist URL; don't serve it again.
+                forget_m3u8(slug, ep)
+                raise
+            finally:
+                # The shield keeps ffmpeg running past wait_for; never leave it
+                # behind without an owner.
+                if not remux.done():
+                    remux.cancel()
+                    await asyncio.gather(remux, return_exceptions=True)
+        # mkstemp creates 0600; the local Bot API server may run as another user.
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_file)
+        raise
+
+async def resend_cached(bot, chat_id: int, slug: str, ep: str) -> bool:
+    file_id = FILE_ID_CACHE.get((slug, ep))
+    if file_id is None:
+        return False
+    try:
+        await bot.send_video(chat_id=chat_id, video=file_id, supports_streaming=True)
+    except BadRequest:
+        # Stale or rejected file_id; fall back to a fresh upload.
+        logging.warning("Cached file_id for %s ep %s rejected", slug, ep)
+        FILE_ID_CACHE.pop((slug, ep), None)
+        return False
+    return True
+
+async def upload_episode(bot, chat_id: int, out_file: str):
+    if LOCAL_MODE:
+        # The local Bot API server reads the file straight from disk.
+        return await bot.send_video(
+            chat_id=chat_id, video=Path(out_file), supports_streaming=True
+        )
+    # PTB's InputFile reads the whole body into memory even when given
+    # an open file, and can't stream it. Do that read in a worker
+    # thread rather than on the event loop, and only one upload at a time.
+    async with UPLOAD_GATE:
+        async with aiofiles.open(out_file, "rb") as f:
+            video = await f.read()
+        try:
+            return await bot.send_video(
+                chat_id=chat_id,
+                video=video,
+                filename=os.path.basename(out_file),
+                supports_streaming=True,
+            )
+        finally:
+            del video
+
 async def download_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     url = update.message.text.strip()
     chat_id = update.effective_chat.id
@@ -87,23 +371,46 @@ async def download_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE)
     status = await update.message.reply_text("⏳ Fetching stream URL…")
     try:
         slug, ep = extract_slug_ep(url)
-        m3u8_url, referer = get_m3u8_and_referer(slug, ep)
+        if await resend_cached(context.bot, chat_id, slug, ep):
+            await set_status(status, "✅ Done!")
+            return
 
         os.makedirs("downloads", exist_ok=True)
         out_file = f"downloads/{slug}_{ep}.mp4"
-        await status.edit_text("⏳ Downloading & remuxing…")
-        remux_hls_to_mp4(m3u8_url, referer, out_file)
+        # Held through the upload, so requesters queued behind the first one
+        # find its file_id and resend that instead of uploading again.
+        async with keyed_lock(_download_locks, out_file):
+            if await resend_cached(context.bot, chat_id, slug, ep):
+                await set_status(status, "✅ Done!")
+                return
+            if not is_fresh(out_file):
+                await fetch_episode(slug, ep, out_file, status)
 
-        await status.edit_text("🚀 Uploading to Telegram…")
-        with open(out_file, "rb") as video:
-            await context.bot.send_video(chat_id=chat_id, video=video)
+            await set_status(status, "🚀 Uploading to Telegram…")
+            msg = await upload_episode(context.bot, chat_id, out_file)
+            if msg.video is not None:
+                FILE_ID_CACHE[(slug, ep)] = msg.video.file_id
 
-        await status.edit_text("✅ Done!")
+        await set_status(status, "✅ Done!")
     except Exception as e:
         logging.exception("Error in download_and_send")
-        await status.edit_text(f"❌ Failed: {e}")
+        await set_status(status, f"❌ Failed: {e}")
 
 #─── Main ───────────────────────────────────────────────────────────────────────
+async def on_startup(app: Application) -> None:
+    global SESSION, VIDEO_ENCODER
+    VIDEO_ENCODER = await detect_video_encoder()
+    logging.info("Fallback video encoder: %s", VIDEO_ENCODER)
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(sock_connect=3, sock_read=10),
+        headers={"Accept-Encoding": "gzip"},
+    )
+
+async def on_shutdown(app: Application) -> None:
+    if SESSION is not None:
+        await SESSION.close()
+
 def main() -> None:
     # LOCAL_API_URL already ends in "/bot/", so Python-telegram-bot will build:
     #   LOCAL_API_URL + TOKEN + "/" + METHOD
@@ -111,6 +418,11 @@ def main() -> None:
         ApplicationBuilder()
         .token(TOKEN)
         .base_url(LOCAL_API_URL)
+        .local_mode(LOCAL_MODE)
+        # Handle chats in parallel; REMUX_GATE bounds the heavy part.
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
         .build()
     )
     app.add_handler(CommandHandler("start", start))
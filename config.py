@@ -0,0 +1,46 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True)
+class Settings:
+    token: str
+    local_api_url: str  # e.g. "http://127.0.0.1:8081/bot/"
+    local_mode: bool    # server started with --local and sharing our filesystem
+    max_remux: int      # concurrent ffmpeg jobs
+    api_base: str
+
+
+@lru_cache(maxsize=None)
+def settings() -> Settings:
+    # Fills in whatever the environment (e.g. systemd's EnvironmentFile)
+    # doesn't already set; existing variables win.
+    load_dotenv()
+
+    token         = os.getenv("TELEGRAM_TOKEN")
+    local_api_url = os.getenv("TELEGRAM_LOCAL_API")
+    if not token:
+        raise RuntimeError("TELEGRAM_TOKEN not set in .env")
+    if not local_api_url:
+        raise RuntimeError("TELEGRAM_LOCAL_API not set in .env (must end in /bot/)")
+
+    try:
+        max_remux = int(os.getenv("MAX_REMUX", "4"))
+    except ValueError:
+        raise RuntimeError("MAX_REMUX must be an integer") from None
+    if max_remux < 1:
+        raise RuntimeError("MAX_REMUX must be at least 1")
+
+    return Settings(
+        token=token,
+        local_api_url=local_api_url,
+        local_mode=os.getenv("TELEGRAM_LOCAL_MODE", "0") == "1",
+        max_remux=max_remux,
+        api_base=os.getenv(
+            "ANIWATCH_API_BASE",
+            "http://localhost:4000/api/v2/hianime"
+        ),
+    )